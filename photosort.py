@@ -1,24 +1,41 @@
+import ctypes
+import ctypes.util
+import errno
+import itertools
 import logging
 import logging.config
-import math
 import os
-import pathlib
 import re
 import shutil
 import sys
-from argparse import ArgumentParser
-from collections import Counter, OrderedDict, defaultdict
+from argparse import ArgumentParser, ArgumentTypeError
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from time import ctime
+from functools import lru_cache
+from operator import itemgetter
 
 import exifread
 
 logger = logging.getLogger(__name__)
 
 LOGGING_CONF_FILENAME = "logging.conf"
+LOGGING_CONF_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), LOGGING_CONF_FILENAME)
 SUPPORTED_GROUPINGS = {"year", "month", "date"}
 IGNORED_FILENAMES_REGEX = r"(\.DS_Store)|(\._.*)"
 DEFAULT_DEST_DIRNAME = "_sorted"
+EXIF_DATETIME_FORMAT = "%Y:%m:%d %H:%M:%S"
+DEFAULT_JOBS = min(32, (os.cpu_count() or 1) * 4)
+PLAN_CHUNKS_PER_JOB = 4
+
+# a file in rootdir, with the stat result from its initial scan
+FileRec = namedtuple("FileRec", "path stat_result createdate")
+
+# clonefile(2) makes copy-on-write clones on APFS
+if sys.platform == "darwin":
+    _clonefile = getattr(ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True), "clonefile", None)
+else:
+    _clonefile = None
 
 
 def parse_args():
@@ -28,159 +45,258 @@ def parse_args():
     parser.add_argument("-g", "--groupby", help="Attribute by which to group photos in a single folder", choices=SUPPORTED_GROUPINGS, default="year")
     parser.add_argument("--rename", help="Specify whether to rename files to <date_fmt>[_idx], preserving file extensions", action="store_true", default=False)
     parser.add_argument("-df", "--dateformat", help="Format of the date portion of resulting file names. Follows datetime.date.strftime convention", default="%Y-%m-%d")
+    parser.add_argument("--link", help="Hard link files into targetdir instead of copying them, if it is on the same filesystem as rootdir. Files that can't be hard linked are copied", action="store_true", default=False)
+    parser.add_argument("-j", "--jobs", help="Number of files to copy concurrently", type=positive_int, default=DEFAULT_JOBS)
     return parser.parse_args()
 
-def validate_filenames(rootdir):
-    error_filepaths = []
-    for filename in os.listdir(rootdir):
-        filepath = os.path.join(rootdir, filename)
-        if os.path.isdir(filepath):
-            logger.warning(f"Directory {filepath} will be ignored.")
-            continue
-        if "." not in filename:
-            error_filepaths.append(filepath)
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+def _iter_entries(rootdir):
+    """
+    Yield `DirEntry`s for the files directly under `rootdir`, in a single
+    scandir pass. Skips ignored file names, and warns on directories.
+    """
+    with os.scandir(rootdir) as it:
+        for entry in it:
+            if entry.is_dir():
+                logger.warning(f"Directory {entry.path} will be ignored.")
+                continue
+            if re.match(IGNORED_FILENAMES_REGEX, entry.name):
+                continue
+            yield entry
+
+def validate_filenames(entries):
+    error_filepaths = [entry.path for entry in entries if "." not in entry.name]
     if error_filepaths:
         message = "The following files have errors. No files have been touched.\n"
         message += "\n".join(error_filepaths)
         raise Exception(message)
 
-def get_files_createdates(rootdir):
+def get_file_records(entries):
     """
-    Return mapping of `rootdir`'s files to their respective create dates,
-    sorted by ascending create date. Ignores directories.
+    Return list of FileRecs for `entries`, sorted by ascending create date.
+    Each file is stat'ed once, and the stat result is reused downstream.
     """
-    rootdir_filepaths = [
-        os.path.join(rootdir, f)
-        for f in os.listdir(rootdir)
-        if not os.path.isdir(os.path.join(rootdir, f)) and not re.match(IGNORED_FILENAMES_REGEX, f)]
-    filepath_createdate_pairs = [(filepath, get_createdate(filepath)) for filepath in rootdir_filepaths]
-    return OrderedDict(sorted(filepath_createdate_pairs, key=lambda elem: elem[1]))
+    stat_results = [entry.stat() for entry in entries]
+    createdates = [get_createdate(entry.path, stat_result) for entry, stat_result in zip(entries, stat_results)]
+    order = sorted(range(len(entries)), key=createdates.__getitem__)
+    return [FileRec(entries[i].path, stat_results[i], createdates[i]) for i in order]
 
-def get_createdate(filename):
+def get_createdate(filename, stat_result=None):
     try:
         with open(filename, "rb") as f:
             exif_data = exifread.process_file(f)
-            og_datetime = str(exif_data["EXIF DateTimeOriginal"]) # %Y:%m%d hh:mm:ss
-            date, time = og_datetime.split(" ")
-            year, month, day = date.split(":")
-            datefmt = "%Y %m %d %H:%M:%S"
+            og_datetime = str(exif_data["EXIF DateTimeOriginal"])
     except KeyError as e:
         logger.warning(f"Bad EXIF data: {filename} error: {e}")
         # default method
-        epoch_createtime = get_epoch_createtime(filename)
-        _, month, day, time, year = epoch_createtime.split()
-        datefmt = "%Y %b %d %H:%M:%S"
-    datetime_obj = datetime.strptime(f"{year} {month} {day} {time}", datefmt)
-    return datetime_obj
-
-def get_epoch_createtime(filename):
-    stat = os.stat(filename)
-    create_date = stat.st_birthtime
-    epoch_createtime = ctime(create_date)
-    return epoch_createtime
-
-def get_year_month_day(datetime_obj):
-    year = str(datetime_obj.year)
-    month = str(datetime_obj.month).rjust(2, "0")
-    day = str(datetime_obj.day).rjust(2, "0")
-    return year, month, day
-
-def construct_groups(files_createdates_dict, groupby):
-    """
-    Construct mapping of groupname -> [filepaths]
-    """
-    groups_dict = defaultdict(list)
-    for filepath, createdate in files_createdates_dict.items():
-        year, month, day = get_year_month_day(createdate)
-        if groupby == "year":
-            groupname = year
-        elif groupby == "month":
-            groupname = f"{year}-{month}"
-        elif groupby == "date":
-            groupname = f"{year}-{month}-{day}"
-        else:
-            raise Exception(f"Unsupported group: {groupby}")
-        groups_dict[groupname].append(filepath)
-    return groups_dict
-
-def construct_copy_mapping(groups_dict, targetdir):
-    """
-    Construct mapping of root file path -> target file path,
-    based on groups assigned in `groups_dict`
-    """
-    copy_dict = {}
-    for groupname, group_filepaths in groups_dict.items():
-        for filepath in group_filepaths:
-            targetgroup_dir = os.path.join(targetdir, groupname)
-            filename = filepath.split(os.path.sep)[-1]
-            targetpath = os.path.join(targetgroup_dir, filename)
-            copy_dict[filepath] = targetpath
-    return copy_dict
-
-def rename_copy_dict(copy_dict, files_createdates_dict, datefmt):
-    """
-    @param copy_dict: mapping of {root_filepath: target_filepath}
-    @param files_createdates_dict: ordered mapping of {root_file_path: createdate}
+        return _parse_epoch(_stat_birthtime(filename, stat_result))
+    return datetime.strptime(og_datetime, EXIF_DATETIME_FORMAT)
+
+def _stat_birthtime(filename, stat_result=None):
+    stat_result = stat_result or os.stat(filename)
+    return int(stat_result.st_birthtime)
+
+@lru_cache(maxsize=1 << 15)
+def _parse_epoch(epoch_createtime):
+    # files from the same burst share a create time, so cache by epoch second
+    return datetime.fromtimestamp(epoch_createtime)
+
+@lru_cache(maxsize=4096)
+def _format_date(createdate, datefmt):
+    # burst photos share a create time, so many strftime calls are repeats
+    return createdate.strftime(datefmt)
+
+def get_groupname_fn(groupby):
+    """
+    Return function mapping a create date to its group name under `groupby`
+    """
+    if groupby == "year":
+        return lambda createdate: f"{createdate.year:04d}"
+    elif groupby == "month":
+        return lambda createdate: f"{createdate.year:04d}-{createdate.month:02d}"
+    elif groupby == "date":
+        return lambda createdate: f"{createdate.year:04d}-{createdate.month:02d}-{createdate.day:02d}"
+    raise Exception(f"Unsupported group: {groupby}")
+
+def _get_file_ext(filename):
+    _, file_ext = os.path.splitext(filename)
+    if not file_ext and filename.startswith("."):
+        # splitext sees no extension in eg. ".localized", so keep everything from the last dot
+        file_ext = filename[filename.rindex("."):]
+    return file_ext
+
+def build_plan(rootdir, targetdir, groupby, rename, datefmt):
+    """
+    Construct list of (root filepath, target filepath, stat_result) entries, sorted
+    by ascending create date, in a single scan of `rootdir`. No files are written.
+    @param groupby: attribute of the create date naming each file's target dir
+    @param rename: whether to rename target files to `datefmt`[_idx]
     @param datefmt: string format of the date to use in target filenames
-    @return: copy_dict, except with target file names renamed to formatted file dates
     """
-    # construct per-date file counts by file path
-    date_counts = Counter([get_year_month_day(cdate_obj) for cdate_obj in files_createdates_dict.values()])
+    # list the files of rootdir once, and reuse the entries for every step
+    entries = list(_iter_entries(rootdir))
+    validate_filenames(entries)
+
+    # file records, sorted by create date
+    file_records = get_file_records(entries)
+
+    # derive everything needed from each create date exactly once
+    get_groupname = get_groupname_fn(groupby)
+    records = [
+        (rec.path, rec.stat_result, rec.createdate, rec.createdate.date(), get_groupname(rec.createdate))
+        for rec in file_records]
+
+    # per-date file counts, used to decide whether renamed files need an idx
+    date_counts = Counter(createdate_date for _, _, _, createdate_date, _ in records)
+    # pad index to the same width for all files with the same create date
+    idx_widths = {createdate_date: len(str(count)) for createdate_date, count in date_counts.items()}
 
-    # construct dict of old name -> new name
     # note that for Apple Live photos, the resulting file names in the target dir will be different
     # eg. IMG_0001.jpeg -> targetdir/groupname/YYYYMMDD_1.jpeg
     #     IMG_0001.mov  -> targetdir/groupname/YYYYMMDD_2.mov
-    renamed_copy_dict = {}
+    plan = []
     seen_dates_counter = Counter()
-    for filepath, createdate_obj in files_createdates_dict.items():
-        new_filename = createdate_obj.strftime(datefmt)
-        createdate_ymd = get_year_month_day(createdate_obj)
-        createdate_count = date_counts[createdate_ymd]
-        if createdate_count > 1:
-            # we only append idx if there is >1 file with same create date
-            seen_dates_counter[createdate_ymd] += 1
-            # pad index if >10 distinct files with same create date.
-            createdate_count_numdigits = int(math.log10(createdate_count)) + 1
-            idx = str(seen_dates_counter[createdate_ymd]).rjust(createdate_count_numdigits, "0")
-            new_filename = f"{new_filename}_{idx}"
-        file_ext = filepath.split(".")[-1]
-        new_filename = f"{new_filename}.{file_ext}"
-        target_filepath = copy_dict[filepath]
-        target_dir = os.path.sep.join(target_filepath.split(os.path.sep)[:-1])
-        new_filepath = os.path.join(target_dir, new_filename)
-        renamed_copy_dict[filepath] = new_filepath
-    return renamed_copy_dict
-
-def copy_files(copy_dict):
-    """
-    Copy files from paths specified in keys of dict to paths
-    specified in values of dict. Does not overwrite files in
-    target location if they already exist. Instead, we return
-    them as a list for caller to use.
+    # records are sorted by create date, so each group is a contiguous run
+    for groupname, group_records in itertools.groupby(records, key=itemgetter(4)):
+        targetgroup_dir = os.path.join(targetdir, groupname)
+        for filepath, stat_result, createdate, createdate_date, _ in group_records:
+            if rename:
+                new_filename = _format_date(createdate, datefmt)
+                createdate_count = date_counts[createdate_date]
+                if createdate_count > 1:
+                    # we only append idx if there is >1 file with same create date
+                    seen_dates_counter[createdate_date] += 1
+                    new_filename = f"{new_filename}_{seen_dates_counter[createdate_date]:0{idx_widths[createdate_date]}d}"
+                filename = f"{new_filename}{_get_file_ext(os.path.basename(filepath))}"
+            else:
+                filename = os.path.basename(filepath)
+            plan.append((filepath, os.path.join(targetgroup_dir, filename), stat_result))
+    return plan
+
+def execute_plan(plan, jobs=DEFAULT_JOBS, link=False):
+    """
+    Copy files from the root paths to the target paths of the
+    (root filepath, target filepath, stat_result) entries in `plan`,
+    splitting the plan into chunks run on up to `jobs` threads. If `link`
+    is set and source and target are on the same filesystem, files are
+    linked rather than copied. Does not overwrite files in target location
+    if they already exist. Instead, we return them as a list for caller to use.
+    """
+    # create target dirs up front, so that copy threads don't race on makedirs
+    target_dirs = {os.path.dirname(target_filepath) for _, target_filepath, _ in plan}
+    for target_dir in target_dirs:
+        os.makedirs(target_dir, exist_ok=True)
+
+    if link and plan:
+        root_dev = os.stat(os.path.dirname(plan[0][0])).st_dev
+        if any(os.stat(target_dir).st_dev != root_dev for target_dir in target_dirs):
+            logger.warning("Target directory is on a different filesystem than rootdir. Copying files instead of linking.")
+            link = False
+
+    # several chunks per thread, so that a chunk of large videos doesn't hold up the rest
+    chunk_size = max(1, len(plan) // (jobs * PLAN_CHUNKS_PER_JOB))
+    chunks = [plan[i:i + chunk_size] for i in range(0, len(plan), chunk_size)]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        chunk_results = executor.map(lambda chunk: execute_plan_chunk(chunk, link), chunks)
+        return [pair for pre_existing_files in chunk_results for pair in pre_existing_files]
+
+def execute_plan_chunk(chunk, link=False):
+    """
+    Copy (or link, if `link` is set) each file of `chunk` and its stats.
+    Returns the (cur, target) pairs that were skipped because the target
+    file already exists.
     """
     pre_existing_files = []
-    for cur_filepath, target_filepath in copy_dict.items():
-        target_dir = os.path.dirname(target_filepath)
-        if not os.path.isdir(target_dir):
-            os.makedirs(target_dir)
-        if os.path.exists(target_filepath):
+    for cur_filepath, target_filepath, _ in chunk:
+        try:
+            if link and _link(cur_filepath, target_filepath):
+                continue
+            cloned = _fast_copy(cur_filepath, target_filepath)
+        except FileExistsError:
+            # do not overwrite file if target file already exists. targets are
+            # created exclusively, so this also holds between concurrent chunks
             pre_existing_files.append((cur_filepath, target_filepath))
-            # do not overwrite file if target file already exists
             continue
-        shutil.copyfile(cur_filepath, target_filepath)
-        shutil.copystat(cur_filepath, target_filepath)
+        if not cloned:
+            # copystat also carries over xattrs and file flags, not just mode and times
+            shutil.copystat(cur_filepath, target_filepath)
     return pre_existing_files
 
-def roll_back(copy_dict, pre_existing_files):
-    pre_existing_target_files = {f[1] for f in pre_existing_files}
-    for target_path in copy_dict.values():
-        if not os.path.exists(target_path) or target_path in pre_existing_target_files:
+def _fast_copy(src, dst):
+    """
+    Copy contents of `src` to a new file `dst` without going through user space
+    where the platform allows it: copy_file_range on Linux, clonefile on macOS.
+    Falls back to shutil.copyfile otherwise, or if the fast path fails.
+    Returns True if `dst` was cloned, which also clones the stats of `src`.
+    Raises FileExistsError if `dst` already exists.
+    """
+    if _clonefile is not None:
+        if _clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0:
+            return True
+        err = ctypes.get_errno()
+        if err == errno.EEXIST:
+            raise FileExistsError(err, os.strerror(err), dst)
+        logger.debug(f"clonefile failed for {src}, falling back to shutil.copyfile. error: {os.strerror(err)}")
+
+    # claim dst atomically, so that no two copies write to the same target
+    with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+        if hasattr(os, "copy_file_range"):
+            try:
+                _copy_file_range(fsrc, fdst)
+                return False
+            except OSError as e:
+                logger.debug(f"copy_file_range failed for {src}, falling back to shutil.copyfile. error: {e}")
+    # dst is ours now, so overwriting it is safe
+    shutil.copyfile(src, dst)
+    return False
+
+def _link(src, dst):
+    """
+    Hard link `src` to `dst`. Returns False if the link could not be made
+    (eg. filesystems without hard link support), in which case the caller
+    copies the file instead. Raises FileExistsError if `dst` already exists.
+    """
+    try:
+        os.link(src, dst)
+        return True
+    except FileExistsError:
+        raise
+    except OSError as e:
+        logger.debug(f"Hard link failed for {src}, copying it instead. error: {e}")
+        _warn_once(f"Could not hard link some files into targetdir. Copying them instead. error: {e.strerror}")
+        return False
+
+@lru_cache(maxsize=None)
+def _warn_once(message):
+    logger.warning(message)
+
+def _copy_file_range(fsrc, fdst):
+    remaining = os.fstat(fsrc.fileno()).st_size
+    while remaining > 0:
+        copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+        if copied == 0:
+            # some filesystems report 0 before EOF. treat it like shutil does, as
+            # unsupported, so that the caller falls back instead of leaving a short file
+            raise OSError(errno.ENOTSUP, "copy_file_range copied 0 bytes before end of file")
+        remaining -= copied
+
+def roll_back(plan, pre_existing_files):
+    # compare whole pairs, since several plan entries may share a target path,
+    # and the one that did get written must still be removed
+    pre_existing_pairs = set(pre_existing_files)
+    for cur_path, target_path, _ in plan:
+        if not os.path.exists(target_path) or (cur_path, target_path) in pre_existing_pairs:
             continue
         os.remove(target_path)
 
-
 def main():
+    logger.setLevel(logging.INFO)
+    logging.config.fileConfig(LOGGING_CONF_PATH, disable_existing_loggers=False)
     opts = parse_args()
     rootdir = os.path.expanduser(opts.rootdir)
     if not opts.targetdir:
@@ -188,33 +304,20 @@ def main():
     else:
         targetdir = os.path.expanduser(opts.targetdir)
 
-    # validate file names
-    validate_filenames(rootdir)
-
-    # dict of filepath -> create datetime object, sorted by create date
-    files_createdates_dict = get_files_createdates(rootdir)
-
-    # construct groups
-    logger.info("Constructing groups...")
-    groups_dict = construct_groups(files_createdates_dict, opts.groupby)
-
-    # construct dict of root paths to target paths
-    logger.info("Constructing copy mapping from rootdir to targetdir...")
-    copy_dict = construct_copy_mapping(groups_dict, targetdir)
-
-    # renaming files
+    # construct list of root paths to target paths
+    logger.info("Constructing copy plan from rootdir to targetdir...")
     if opts.rename:
-        logger.info(f"Updating copy mapping to rename files to {opts.dateformat}[_idx] format...")
-        copy_dict = rename_copy_dict(copy_dict, files_createdates_dict, opts.dateformat)
+        logger.info(f"Renaming files to {opts.dateformat}[_idx] format...")
+    plan = build_plan(rootdir, targetdir, opts.groupby, opts.rename, opts.dateformat)
 
-    # apply the copy of files over to targetdir
+    # apply the copy of files over to targetdir, only once the whole plan is built
     logger.info(f"Copying files from {rootdir} to {targetdir}...")
-    pre_existing_files = copy_files(copy_dict)
+    pre_existing_files = execute_plan(plan, opts.jobs, opts.link)
     if pre_existing_files:
         fmtted_pre_existing_files = "\n".join([f"{pair[0]} -> {pair[1]}" for pair in pre_existing_files])
         msg = f"Failed to write to following files. Rolling back all copied files.\n{fmtted_pre_existing_files}"
         logger.error(msg)
-        roll_back(copy_dict, pre_existing_files)
+        roll_back(plan, pre_existing_files)
         return 1
 
     logger.info("Completed successfully")
@@ -222,8 +325,5 @@ def main():
 
 
 if __name__ == "__main__":
-    logger.setLevel(logging.INFO)
-    log_config_path = os.path.join(pathlib.Path(__file__).parent.absolute(), LOGGING_CONF_FILENAME)
-    logging.config.fileConfig(log_config_path, disable_existing_loggers=False)
     exitcode = main()
     sys.exit(exitcode)